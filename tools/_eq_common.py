@@ -0,0 +1,174 @@
+# tools/_eq_common.py
+import threading
+import time
+from pathlib import Path
+
+import ijson
+import orjson
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# ------------------------------------------------------------
+# Gemensam bas för EQ-scripten i tools/:
+# HTTP-session (cache + retry + rate limit), MediaWiki-anrop och JSON-IO.
+# Scripten körs som "python tools/<script>.py", så tools/ ligger på sys.path.
+# ------------------------------------------------------------
+
+BASE = "https://tibia.fandom.com"
+API  = f"{BASE}/api.php"
+
+# Accept-Encoding sätts inte: requests default ber redan om gzip/deflate (och br/zstd
+# om brotli/zstandard finns installerade) och packar upp automatiskt
+HEADERS = {
+    "User-Agent": "TibiaSweden-EQOpt/1.1 (catalog builder; github.com/YamiXs/Tibia-EQ)",
+}
+
+# Repots data/-katalog, oberoende av arbetskatalogen (SESSION skapas vid import)
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+# HTTP-cache (sqlite) mellan körningar; cachas mellan CI-körningar via actions/cache
+HTTP_CACHE = DATA_DIR / ".http_cache.sqlite"
+
+# Artigt mot Fandom: max RATE_PER_SEC requests/s totalt (alla trådar)
+RATE_PER_SEC = 4.0
+
+# ------------------------------------------------------------
+# IO helpers
+# ------------------------------------------------------------
+# orjson: UTF-8 ut som standard (motsvarar ensure_ascii=False), indent 2 som förut
+def load_json(path, default):
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return default
+
+def save_json(path, data):
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE))
+
+def load_jsonl(path, default):
+    try:
+        with open(path, "rb") as f:
+            return [orjson.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return default
+
+def save_jsonl_append(path, rows):
+    with open(path, "ab") as f:
+        for r in rows:
+            f.write(orjson.dumps(r, option=orjson.OPT_APPEND_NEWLINE))
+
+# ------------------------------------------------------------
+# Rate limit (delas mellan trådarna)
+# ------------------------------------------------------------
+_rate_lock = threading.Lock()
+_next_slot = 0.0
+
+def rate_limit():
+    # Varje anrop får en egen tidslucka, 1/RATE_PER_SEC sekunder isär
+    global _next_slot
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _next_slot)
+        _next_slot = slot + 1.0 / RATE_PER_SEC
+    delay = slot - now
+    if delay > 0:
+        time.sleep(delay)
+
+class RateLimitedAdapter(HTTPAdapter):
+    # Sitter under cachen => bara riktiga nätverksanrop (miss/revalidering) väntar på en lucka
+    def send(self, request, **kwargs):
+        rate_limit()
+        return super().send(request, **kwargs)
+
+# ------------------------------------------------------------
+# HTTP session
+# ------------------------------------------------------------
+# En delad Session => keep-alive + connection pool (ingen ny TLS-handshake per titel).
+# Cachad på disk: färska svar tas direkt, gamla revalideras med ETag/Last-Modified (304 = ingen body).
+SESSION = requests_cache.CachedSession(
+    HTTP_CACHE,
+    backend="sqlite",
+    cache_control=True,
+    expire_after=86400,
+)
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", RateLimitedAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# ------------------------------------------------------------
+# MediaWiki API
+# ------------------------------------------------------------
+def api_get(params: dict) -> dict:
+    r = SESSION.get(API, params=params, timeout=30)
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    # API-fel (ratelimited, maxlag, ...) kommer som HTTP 200 med {"error": ...}.
+    # Ta bort svaret ur cachen så att en omkörning går till nätet, och kasta så att
+    # anroparen ser ett misslyckat anrop i stället för ett tomt resultat.
+    if "error" in data:
+        SESSION.cache.delete(requests=[r.request])
+        err = data["error"]
+        raise RuntimeError(f"MediaWiki API error: {err.get('code')}: {err.get('info')}")
+    return data
+
+def _stream_category_page(params: dict) -> tuple[list[str], str | None]:
+    # Strömmar ett categorymembers-svar genom ijson: titlar och cmcontinue plockas
+    # ut medan bytes kommer in, inget fullt JSON-träd byggs.
+    titles: list[str] = []
+    cont = None
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events)
+
+    def consume():
+        nonlocal cont
+        for prefix, _event, value in events:
+            if prefix == "query.categorymembers.item.title":
+                titles.append(value)
+            elif prefix == "continue.cmcontinue":
+                cont = value
+        del events[:]
+
+    # Utan cache: CachedSession läser in hela bodyn för att spara den innan
+    # iter_content ger första biten, och då strömmas inget. Listningen körs bara
+    # från en tråd (build_titles / build_eq_titles), så avstängningen krockar inte.
+    with SESSION.cache_disabled():
+        with SESSION.get(API, params=params, timeout=45, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                parser.send(chunk)
+                consume()
+    parser.close()
+    consume()
+
+    return titles, cont
+
+def list_category_members(category_name: str) -> list[str]:
+    titles: list[str] = []
+    cont = None
+
+    while True:
+        params = {
+            "action": "query",
+            "list": "categorymembers",
+            "cmtitle": f"Category:{category_name}",
+            "cmnamespace": 0,     # main namespace only
+            "cmtype": "page",     # exclude subcats/files
+            "cmlimit": 500,       # max per request (typical)
+            "format": "json",
+        }
+        if cont:
+            params["cmcontinue"] = cont
+
+        page_titles, cont = _stream_category_page(params)
+        titles.extend(page_titles)
+
+        if not cont:
+            break
+
+    return titles
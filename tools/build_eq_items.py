@@ -1,32 +1,67 @@
 # tools/build_eq_items.py
-import json
+import argparse
 import re
+import sqlite3
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 from urllib.parse import quote
 
-import requests
-from bs4 import BeautifulSoup
+import orjson
+
+from _eq_common import (
+    BASE,
+    DATA_DIR,
+    SESSION,
+    api_get,
+    list_category_members,
+    load_json,
+    load_jsonl,
+    save_json,
+    save_jsonl_append,
+)
 
 # ------------------------------------------------------------
 # TibiaSweden EQ Catalog Builder
-# - Bygger en titel-lista (data/eq_titles.json) från slot-sidor + set-sidor
-#   (OBS: Denna metod kan plocka upp "skräp-länkar" — men vi har starka guards
-#   som filtrerar bort creatures och icke-item-sidor.)
-# - Processar titlar i batchar (data/eq_state.json) och uppdaterar data/eq_items.json
+# - Bygger en titel-lista (data/eq_titles.json) från slot-kategorier (list=categorymembers)
+#   + länkarna på set-sidorna (prop=links). Ingen HTML-skrapning; guards finns kvar
+#   för set-sidornas länkar som kan peka på creatures/icke-items.
+# - Processar titlar i batchar (data/eq_state.json) och lägger till nya items sist i
+#   data/eq_items.jsonl (append-only). data/eq_items.json är en snapshot som bara
+#   skrivs om med --snapshot: {source-URL: item} (vill man ha en lista: values()).
 #
 # Viktigt:
 # - Scriptet sparar "progress" i repo så GitHub Actions kan fortsätta nästa körning.
 # - Det tar bara items som faktiskt har protection/resist-info.
 # ------------------------------------------------------------
 
-BASE = "https://tibia.fandom.com"
-API  = f"{BASE}/api.php"
+# Parallella hämtningar; takten styrs globalt av RATE_PER_SEC i _eq_common
+WORKERS = 4
+
+# Max titlar per action=query (MediaWikis gräns för vanliga klienter)
+QUERY_BATCH = 50
 
-UA = {"User-Agent": "TibiaSweden-EQOpt/1.1 (catalog builder)"}
+# Parse-resultat per titel (senaste revid); höj PARSE_VERSION när parse-logiken ändras
+PARSE_CACHE = DATA_DIR / ".parse_cache.sqlite"
+PARSE_VERSION = 2
 
 ELEMENTS = ["physical", "fire", "ice", "energy", "earth", "death", "holy"]
 
-# Seed-sidor: bra bredd, men ger ibland extralänkar (guards tar hand om det)
+# Gemen elementnamn -> en delad (internerad) sträng: alla items res-nycklar pekar på
+# samma objekt i stället för en ny sträng från .lower() per träff
+ELEMENT_INTERN = {e: sys.intern(e) for e in ELEMENTS}
+
+# Sökord (gemener) -> voc-kod, i den ordning de ska listas
+VOCATIONS = (
+    ("knight", "KNIGHT"),
+    ("paladin", "PALADIN"),
+    ("druid", "DRUID"),
+    ("sorcerer", "SORCERER"),
+    ("monk", "MONK"),
+)
+
+# Seeds: slot -> kategori (utan "Category:"), "_set" -> set-sida vars länkar tas med
 SEEDS = [
     ("helmet", "Helmets"),
     ("armor", "Armors"),
@@ -44,63 +79,90 @@ SEEDS = [
     ("_set", "Holy_Protection_Set"),
 ]
 
-# Matchar både "protection fire 5%" och "fire 5%"
+# Matchar både "protection fire 5%" och "fire 5%" (ett valfritt "protection "-prefix
+# ändrar inte grupperna, bara kostar ett extra försök på varje position)
 PROT_RE = re.compile(
-    r"(?:protection\s+)?(physical|fire|ice|energy|earth|death|holy)\s*([+-]?\d+)\s*%",
+    r"(physical|fire|ice|energy|earth|death|holy)\s*([+-]?\d+)\s*%",
     re.IGNORECASE
 )
 
+LEVEL_RE = re.compile(r"of level\s+(\d+)\s+or higher", re.IGNORECASE)
+
+# Wikitext: infobox-parametrar ({{Infobox Object|... | levelrequired = 100 | ...}}).
+# PROT_RE täcker redan "| resist = fire +5%, ice -2%"; dessa körs parallellt med
+# fritext-mönstren ovan och vinner när de finns.
+LEVEL_PARAM_RE = re.compile(r"\|\s*levelrequired\s*=\s*(\d+)", re.IGNORECASE)
+VOC_PARAM_RE = re.compile(r"\|\s*vocrequired\s*=\s*([^|}\n]*)", re.IGNORECASE)
+IMBUE_PARAM_RE = re.compile(r"\|\s*imbueslots\s*=\s*(\d+)", re.IGNORECASE)
+
+# Guard-mönster (se looks_like_creature / looks_like_item)
+CREATURE_RE = re.compile(r"\bHitpoints\b|\bExperience Points\b|\bBestiary\b|\bCreature\b", re.I)
+ITEM_RE = re.compile(
+    r"\{\{\s*Infobox[ _]Object\b|\bImbuements?\b|\bIt weighs\b|\bYou see\b|\bArm:\b|\bProtection\b",
+    re.I
+)
+
 # ------------------------------------------------------------
 # Guards (superviktigt)
 # ------------------------------------------------------------
 def looks_like_creature(page_text: str) -> bool:
     # Typiska signaler på creature-sidor på TibiaWiki/Fandom
-    return bool(re.search(r"\bHitpoints\b|\bExperience Points\b|\bBestiary\b|\bCreature\b", page_text, re.I))
+    return bool(CREATURE_RE.search(page_text))
 
 def looks_like_item(page_text: str) -> bool:
     # Typiska signaler på item-sidor (räcker för filtrering)
-    return bool(re.search(r"\bImbuements?\b|\bIt weighs\b|\bYou see\b|\bArm:\b|\bProtection\b", page_text, re.I))
-
-# ------------------------------------------------------------
-# IO helpers
-# ------------------------------------------------------------
-def load_json(path, default):
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return default
-
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    return bool(ITEM_RE.search(page_text))
 
 # ------------------------------------------------------------
 # MediaWiki parse API
 # ------------------------------------------------------------
-def api_parse_html(page: str) -> str:
+def api_query_wikitext(titles: list[str]) -> dict[str, tuple[int, str]]:
+    # Källtexten för upp till QUERY_BATCH sidor i ett anrop (action=parse tar bara en sida).
+    # Returnerar {titel som skickades: (revid, wikitext)}; saknade/ogiltiga titlar utelämnas.
+    params = {
+        "action": "query",
+        "prop": "revisions",
+        "rvprop": "ids|content",
+        "rvslots": "main",
+        "titles": "|".join(titles),
+        "format": "json",
+        "origin": "*",
+    }
+    norm = {}
+    texts = {}
+    while True:
+        data = api_get(params)
+        query = data.get("query", {})
+        norm.update({n["from"]: n["to"] for n in query.get("normalized", [])})
+        for page in query.get("pages", {}).values():
+            revs = page.get("revisions")
+            if revs:
+                texts[page["title"]] = (revs[0]["revid"], revs[0]["slots"]["main"]["*"])
+
+        # Stora svar kan delas upp av servern; fortsätt tills allt är hämtat
+        cont = data.get("continue")
+        if not cont:
+            break
+        params.update(cont)
+
+    out = {}
+    for t in titles:
+        text = texts.get(norm.get(t, t))
+        if text is not None:
+            out[t] = text
+    return out
+
+def api_parse_links(page: str) -> list[str]:
+    # Strukturerade länkar från en sida: [{"ns": 0, "exists": "", "*": "Title"}, ...]
     params = {
         "action": "parse",
         "page": page,
-        "prop": "text",
+        "prop": "links",
         "format": "json",
         "origin": "*",
     }
-    r = requests.get(API, params=params, headers=UA, timeout=30)
-    r.raise_for_status()
-    return r.json()["parse"]["text"]["*"]
-
-def title_from_href(href: str):
-    if not href.startswith("/wiki/"):
-        return None
-    title = href[len("/wiki/"):]
-    title = title.split("#", 1)[0]
-    bad_prefix = ("File:", "Category:", "Special:", "Template:", "Help:", "Talk:", "TibiaWiki:")
-    if any(title.startswith(p) for p in bad_prefix):
-        return None
-    if title in ("Main_Page",):
-        return None
-    return title
+    links = api_get(params)["parse"]["links"]
+    return [l["*"] for l in links if l.get("ns") == 0 and "exists" in l]
 
 # ------------------------------------------------------------
 # Build titles (seed pages -> titles)
@@ -108,59 +170,75 @@ def title_from_href(href: str):
 def build_titles():
     titles = {}  # title -> slot
     for slot, page in SEEDS:
-        html = api_parse_html(page)
-        soup = BeautifulSoup(html, "html.parser")
-        root = soup.select_one(".mw-parser-output") or soup
-
-        for a in root.select("a[href]"):
-            href = a.get("href", "")
-            t = title_from_href(href)
-            if not t:
+        if slot == "_set":
+            names = api_parse_links(page)
+        else:
+            names = list_category_members(page)
+
+        for name in names:
+            t = name.replace(" ", "_")
+            if t in ("Main_Page",):
                 continue
             if t not in titles:
                 titles[t] = None if slot == "_set" else slot
 
-        time.sleep(0.25)
-
     out = [{"title": t, "slot": titles[t]} for t in sorted(titles.keys())]
     return out
 
 # ------------------------------------------------------------
-# Parse one item page
+# Parse one item page (wikitext)
 # ------------------------------------------------------------
-def parse_item(title: str):
-    html = api_parse_html(title)
-    text = BeautifulSoup(html, "html.parser").get_text(" ", strip=True)
-
+def parse_item_from_wikitext(text: str):
     # ✅ Guard: släpp inte igenom creatures / icke-items
     if looks_like_creature(text) or not looks_like_item(text):
         return None
 
+    # Snabbt ut: PROT_RE kräver "%", så ett item utan det har inga resists och
+    # sorteras bort i main ändå. Tom res (inte None) så det inte räknas som icke-item;
+    # övriga fält med standardvärden så formen är densamma som nedan.
+    if "%" not in text:
+        return {
+            "res": {},
+            "imbueSlots": 0,
+            "level": None,
+            "voc": ["ANY"]
+        }
+
     res = {}
     for m in PROT_RE.finditer(text):
-        el = m.group(1).lower()
-        val = int(m.group(2))
-        if el in ELEMENTS:
-            res[el] = val
+        el = ELEMENT_INTERN.get(m.group(1).lower())
+        if el:
+            res[el] = int(m.group(2))
 
-    # Imbuement slots: ofta “Empty Slot” i item-boxen
-    imbue_slots = text.lower().count("empty slot")
+    # Gemen-kopian behövs bara av fritext-fallbackarna; skapas högst en gång, och
+    # inte alls när infoboxen har både imbueslots och vocrequired
+    low = None
+
+    # Imbuement slots: "imbueslots = N" i infoboxen, annars “Empty Slot” i fritext
+    m = IMBUE_PARAM_RE.search(text)
+    if m:
+        imbue_slots = int(m.group(1))
+    else:
+        low = text.lower()
+        imbue_slots = low.count("empty slot")
 
     level = None
-    m = re.search(r"of level\s+(\d+)\s+or higher", text, re.IGNORECASE)
+    m = LEVEL_PARAM_RE.search(text) or LEVEL_RE.search(text)
     if m:
         level = int(m.group(1))
 
     voc = ["ANY"]
-    low = text.lower()
-    if "only be wielded properly by" in low:
-        v = []
-        if "knight" in low: v.append("KNIGHT")
-        if "paladin" in low: v.append("PALADIN")
-        if "druid" in low: v.append("DRUID")
-        if "sorcerer" in low: v.append("SORCERER")
-        if "monk" in low: v.append("MONK")
-        voc = v if v else ["ANY"]
+    m = VOC_PARAM_RE.search(text)
+    if m:
+        req = m.group(1).lower()
+        voc = [code for kw, code in VOCATIONS if kw in req] or ["ANY"]
+    else:
+        if low is None:
+            low = text.lower()
+        # Billig kontroll först; de fem voc-sökningarna bara om sidan har en restriktion
+        if "only be wielded properly by" in low:
+            v = [code for kw, code in VOCATIONS if kw in low]
+            voc = v if v else ["ANY"]
 
     return {
         "res": res,
@@ -172,10 +250,60 @@ def parse_item(title: str):
 # ------------------------------------------------------------
 # Main
 # ------------------------------------------------------------
+def open_parse_cache(path):
+    # En rad per sida: revid/version är kolumner och skrivs över när sidan ändras,
+    # så tabellen växer bara med antalet titlar
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS pages("
+        "title TEXT PRIMARY KEY, revid INTEGER, version INTEGER, json TEXT)"
+    )
+    return db
+
+def cached_parse(db, title, revid, text):
+    # Samma revision + parse-version => samma resultat; hoppa över guards/regex.
+    # Träffar uppstår när titlar hämtas igen: index som hålls kvar efter ett
+    # misslyckat fetch, en manuell reset av eq_state.json eller en ombyggd titellista.
+    row = db.execute(
+        "SELECT json FROM pages WHERE title = ? AND revid = ? AND version = ?",
+        (title, revid, PARSE_VERSION),
+    ).fetchone()
+    if row:
+        return orjson.loads(row[0])
+    meta = parse_item_from_wikitext(text)
+    db.execute(
+        "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)",
+        (title, revid, PARSE_VERSION, orjson.dumps(meta).decode()),
+    )
+    return meta
+
+def load_items(items_path, snapshot_path):
+    # items = {source-URL: item}; senare JSONL-rader för samma URL vinner (upsert)
+    rows = load_jsonl(items_path, None)
+    if rows is None:
+        # Första körningen med JSONL: migrera från den gamla snapshoten
+        # (lista i äldre format, dict {source: item} i nuvarande)
+        old = load_json(snapshot_path, {})
+        rows = list(old.values()) if isinstance(old, dict) else old
+        save_jsonl_append(items_path, rows)
+    return {it["source"]: it for it in rows}
+
 def main():
-    titles_path = "data/eq_titles.json"
-    state_path  = "data/eq_state.json"
-    items_path  = "data/eq_items.json"
+    ap = argparse.ArgumentParser(description="Build the TibiaSweden EQ catalog in batches.")
+    ap.add_argument("--snapshot", action="store_true",
+                    help="rewrite data/eq_items.json from data/eq_items.jsonl and exit")
+    args = ap.parse_args()
+
+    titles_path   = "data/eq_titles.json"
+    state_path    = "data/eq_state.json"
+    items_path    = "data/eq_items.jsonl"
+    snapshot_path = "data/eq_items.json"
+
+    if args.snapshot:
+        items = load_items(items_path, snapshot_path)
+        save_json(snapshot_path, items)
+        print(f"Snapshot: {len(items)} items -> {snapshot_path}")
+        return
 
     titles = load_json(titles_path, None)
     if not titles:
@@ -189,8 +317,9 @@ def main():
         "lastRun": None
     })
 
-    items = load_json(items_path, [])
-    existing = set((it.get("source") or it.get("name") or "").strip() for it in items)
+    items = load_items(items_path, snapshot_path)
+    # name = title med mellanslag => redan importerade titlar hoppas över före HTTP/parse
+    existing_titles = {(it.get("name") or "").replace(" ", "_") for it in items.values()}
 
     start = int(state.get("index", 0))
     batch = int(state.get("batchSize", 60))
@@ -199,19 +328,65 @@ def main():
     processed = 0
     added = 0
     skipped_non_item = 0
+    new_items = []
+
+    # Hämta wikitext i klumpar om QUERY_BATCH titlar (parallellt); parse + resultat
+    # hanteras i huvudtråden (items/existing_titles rörs bara här)
+    todo = [i for i in range(start, end) if titles[i]["title"] not in existing_titles]
+    chunks = [todo[k:k + QUERY_BATCH] for k in range(0, len(todo), QUERY_BATCH)]
+    fetched = {}        # index -> (revid, wikitext)
+    missing = []        # titlar som API:t inte gav någon text för (saknas/ogiltig titel)
+    failed_chunks = []
+
+    def collect(chunk, texts):
+        for i in chunk:
+            t = titles[i]["title"]
+            if t in texts:
+                fetched[i] = texts[t]
+            else:
+                missing.append(i)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        futures = {
+            pool.submit(api_query_wikitext, [titles[i]["title"] for i in chunk]): chunk
+            for chunk in chunks
+        }
+        for fut in as_completed(futures):
+            try:
+                collect(futures[fut], fut.result())
+            except Exception:
+                failed_chunks.append(futures[fut])
+
+    # En omkörning per misslyckad klump; misslyckas den igen stannar index på den
+    # lägsta titeln så att nästa körning tar om dem (i stället för att tappa 50 titlar)
+    fetch_failed = []
+    for chunk in failed_chunks:
+        try:
+            collect(chunk, api_query_wikitext([titles[i]["title"] for i in chunk]))
+        except Exception as e:
+            print(f"Fetch failed for {len(chunk)} titles from {titles[chunk[0]]['title']}: {e}")
+            fetch_failed.extend(chunk)
+
+    results = {}
+    parse_failed = 0
+    parse_cache = open_parse_cache(PARSE_CACHE)
+    for i, (revid, text) in fetched.items():
+        try:
+            results[i] = cached_parse(parse_cache, titles[i]["title"], revid, text)
+        except Exception:
+            parse_failed += 1
+    parse_cache.commit()
+    parse_cache.close()
 
-    for i in range(start, end):
+    for i in todo:
         t = titles[i]["title"]
         slot = titles[i].get("slot") or "unknown"
 
-        try:
-            meta = parse_item(t)
-        except Exception:
-            state["index"] = i + 1
+        if i not in results:
             continue
 
+        meta = results[i]
         processed += 1
-        time.sleep(0.25)
 
         if meta is None:
             skipped_non_item += 1
@@ -221,10 +396,7 @@ def main():
             continue
 
         src = f"{BASE}/wiki/{quote(t)}"
-        if src in existing:
-            continue
-
-        items.append({
+        item = {
             "name": t.replace("_", " "),
             "slot": slot,
             "level": meta["level"],
@@ -232,24 +404,34 @@ def main():
             "res": meta["res"],
             "imbueSlots": meta["imbueSlots"],
             "source": src
-        })
-        existing.add(src)
+        }
+        items[src] = item
+        new_items.append(item)
+        existing_titles.add(t)
         added += 1
 
-    state["index"] = end
+    state["index"] = min(fetch_failed) if fetch_failed else end
     state["lastRun"] = int(time.time())
     state["lastAdded"] = added
     state["lastProcessed"] = processed
     state["lastSkippedNonItem"] = skipped_non_item
+    state["lastFetchFailed"] = len(fetch_failed)
+    state["lastMissing"] = len(missing)
+    state["lastParseFailed"] = parse_failed
     state["totalTitles"] = len(titles)
     state["totalItems"] = len(items)
 
-    save_json(items_path, items)
+    save_jsonl_append(items_path, new_items)
     save_json(state_path, state)
 
+    # Håll cache-filen liten. Inte expired=True: utgångna svar med ETag/Last-Modified
+    # behövs för att nästa veckas körning ska kunna få 304 i stället för hela sidan.
+    SESSION.cache.delete(older_than=timedelta(days=30))
+
     print(
         f"Titles: {len(titles)} | Processed: {processed} | "
         f"SkippedNonItem: {skipped_non_item} | Added: {added} | "
+        f"FetchFailed: {len(fetch_failed)} | Missing: {len(missing)} | ParseFailed: {parse_failed} | "
         f"Items: {len(items)} | Next index: {state['index']}"
     )
 
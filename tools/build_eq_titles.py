@@ -2,16 +2,12 @@
 # Builds data/eq_titles.json by querying TibiaWiki (Fandom) categories via MediaWiki API.
 # This avoids "creature links" leaking in from list pages.
 
-import json
-import time
 import datetime as dt
-import urllib.parse
-import urllib.request
 
-API = "https://tibia.fandom.com/api.php"
-HEADERS = {
-    "User-Agent": "TibiaSweden-TibiaEQ/1.0 (github.com/YamiXs/Tibia-EQ)"
-}
+from _eq_common import list_category_members, save_json
+
+# HTTP goes through the shared _eq_common.SESSION (keep-alive pool, retry, disk cache,
+# global rate limit), the same one build_eq_items.py uses.
 
 # Slot -> Category name (without "Category:")
 SLOT_CATEGORIES = {
@@ -28,42 +24,6 @@ SLOT_CATEGORIES = {
     # "body_equipment": "Body_Equipment",
 }
 
-def api_get(params: dict) -> dict:
-    qs = urllib.parse.urlencode(params)
-    url = f"{API}?{qs}"
-    req = urllib.request.Request(url, headers=HEADERS)
-    with urllib.request.urlopen(req, timeout=45) as resp:
-        return json.load(resp)
-
-def list_category_members(category_name: str) -> list[str]:
-    titles: list[str] = []
-    cont = None
-
-    while True:
-        params = {
-            "action": "query",
-            "list": "categorymembers",
-            "cmtitle": f"Category:{category_name}",
-            "cmnamespace": 0,     # main namespace only
-            "cmtype": "page",     # exclude subcats/files
-            "cmlimit": 500,       # max per request (typical)
-            "format": "json",
-        }
-        if cont:
-            params["cmcontinue"] = cont
-
-        data = api_get(params)
-        members = data.get("query", {}).get("categorymembers", [])
-        titles.extend([m["title"] for m in members if "title" in m])
-
-        cont = data.get("continue", {}).get("cmcontinue")
-        if not cont:
-            break
-
-        time.sleep(0.2)  # be polite
-
-    return titles
-
 def main():
     out = {
         "generatedAt": dt.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
@@ -87,8 +47,7 @@ def main():
 
     out["count"] = len(out["items"])
 
-    with open("data/eq_titles.json", "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    save_json("data/eq_titles.json", out)
 
     print(f"OK: wrote data/eq_titles.json with {out['count']} titles")
 